@@ -0,0 +1,90 @@
+#!/usr/bin/env python3.10
+import argparse
+import json
+import sys
+import time
+import xmlrpc.client
+
+import yaml
+
+from prupload import OdooSession, PayrollBill, PayrollError, TRANSPORTS, bill_to_line_values
+
+
+def _encode_response(transport, result) -> bytes:
+    """Encode a result the way the Odoo server would send it back"""
+
+    if transport.name == 'xmlrpc':
+        return xmlrpc.client.dumps((result,), methodresponse=True, allow_none=True).encode()
+    return json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': result}).encode()
+
+
+def _time(func, iterations: int) -> float:
+    """:returns milliseconds per call"""
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(conflict_handler='resolve',
+                                     description='Compare payload size and serialization time of the Odoo transports'
+                                     )
+    parser.add_argument('-c', '--config', dest='configfile', type=str, required=False,
+                        default='/usr/local/etc/prupload.conf',
+                        help='specify a different config file (default "/usr/local/etc/prupload.conf")')
+    parser.add_argument('-s', '--server', dest='server', type=str, required=False,
+                        help='also time logging in to this server from the config file with each transport')
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int, required=False, default=200,
+                        help='number of times each payload is encoded and decoded (default 200)')
+    parser.add_argument('-a', '--accounts', dest='accounts', type=int, required=False, default=2000,
+                        help='number of account.account records in the simulated search_read (default 2000)')
+    parser.add_argument('input', metavar='input', type=str, nargs='+', help='payroll filenames')
+
+    args = parser.parse_args()
+
+    with open(args.configfile) as f:
+        config: dict = yaml.safe_load(f)
+
+    # Every account code in the config file gets a made up id, so no server is needed
+    codes = set(config['accounts']['departments'].values()) | set(config['accounts']['expenses'].values()) | {"20100"}
+    code_ids = {code: n for n, code in enumerate(sorted(codes), 1)}
+    accounts = [{'id': n, 'code': f"{n:05d}"} for n in range(1, args.accounts + 1)]
+
+    print(f"{'transport':<16}{'payload':<28}{'bytes':>10}{'encode ms':>12}{'decode ms':>12}")
+    for name, transport_class in TRANSPORTS.items():
+        for compress in (False, True):
+            transport = transport_class('http://localhost', compress=compress)
+            label = name + (' + gzip' if compress else '')
+
+            for filename in args.input:
+                try:
+                    with open(filename, newline='') as infile:
+                        bill = PayrollBill.load(infile, config)
+                except PayrollError as e:
+                    print(f"{filename}: {e}", file=sys.stderr)
+                    continue
+
+                request = ['db', 2, 'password', 'account.move.line', 'create', [bill_to_line_values(bill, 1, code_ids)], {}]
+                body = transport.request_body('object', 'execute_kw', request)
+                encode_ms = _time(lambda: transport.request_body('object', 'execute_kw', request), args.iterations)
+                print(f"{label:<16}{filename + ' lines':<28}{len(body):>10}{encode_ms:>12.3f}{'':>12}")
+
+            # compress only applies to requests, responses are the same either way
+            if compress:
+                continue
+            response = _encode_response(transport, accounts)
+            decode_ms = _time(lambda: transport.decode_response(response), args.iterations)
+            print(f"{label:<16}{f'{args.accounts} accounts':<28}{len(response):>10}{'':>12}{decode_ms:>12.3f}")
+
+    if args.server:
+        print(f"\n{'transport':<16}{'login + account ids ms':>24}")
+        for name in TRANSPORTS:
+            server_config = dict(config[args.server], transport=name)
+            session = OdooSession(dict(config, **{args.server: server_config}), args.server)
+            print(f"{name:<16}{_time(session.connect, max(args.iterations // 20, 1)):>24.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import copy
+import gzip
+import itertools
+import json
+import threading
+import xmlrpc.client
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOdooError(Exception):
+    """Sent back to the client the way Odoo reports a server error"""
+
+
+class FakeOdoo:
+    """
+    In-memory stand-in for the accounts, vendor bills and journal items prupload works with, used to record
+    the synthetic cassettes when odoo-dev can't be reached. It is not Odoo: only the calls prupload makes are
+    supported, and computed fields like debit and credit are a rough guess at what Odoo returns.
+    """
+
+    def __init__(self, account_codes: list[str], uid: int = 2):
+        """
+        :param account_codes: codes of the accounts on the server
+        :type account_codes: list[str]
+        :param uid: user id every login gets
+        :type uid: int
+        """
+
+        self.uid: int = uid
+        self.accounts: dict[int, dict] = {
+            n: {'id': n, 'code': code, 'name': f"Account {code}", 'deprecated': False}
+            for n, code in enumerate(account_codes, 1)
+        }
+        self.moves: dict[int, dict] = {}
+        self.lines: dict[int, dict] = {}
+
+        self._move_ids = itertools.count(1)
+        self._line_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def authenticate(self, db: str, login: str, password: str, user_agent_env: dict) -> int:
+        return self.uid
+
+    def execute_kw(self, db: str, uid: int, password: str, model: str, method: str, args: list, kwargs: dict = None):
+        if uid != self.uid:
+            raise FakeOdooError("Access Denied")
+
+        handler = getattr(self, f"_{model.replace('.', '_')}_{method}", None)
+        if handler is None:
+            raise FakeOdooError(f"{model}.{method} is not supported by the fake Odoo server")
+
+        with self._lock:
+            # Like Odoo's transaction per call, nothing is kept from a call that fails
+            moves, lines = copy.deepcopy(self.moves), copy.deepcopy(self.lines)
+            try:
+                return handler(*args, **(kwargs or {}))
+            except FakeOdooError:
+                self.moves, self.lines = moves, lines
+                raise
+
+    def _account_account_search_read(self, domain: list, fields: list = None) -> list[dict]:
+        return [_read(account, fields) for account in self.accounts.values() if _matches(account, domain)]
+
+    def _account_move_create(self, vals: dict) -> int:
+        move_id = next(self._move_ids)
+        self.moves[move_id] = dict(vals, id=move_id, state='draft')
+        return move_id
+
+    def _account_move_search_read(self, domain: list, fields: list = None, limit: int = None) -> list[dict]:
+        moves = [_read(move, fields) for move in self.moves.values() if _matches(move, domain)]
+        return moves[:limit] if limit else moves
+
+    def _account_move_write(self, ids: list[int], vals: dict) -> bool:
+        for move_id in ids:
+            move = self._move(move_id)
+            for command in vals.get('line_ids', []):
+                match command:
+                    case [0, _, line_vals]:
+                        self._create_line(dict(line_vals, move_id=move_id))
+                    case [1, line_id, line_vals]:
+                        self._line(line_id).update(line_vals)
+                    case [2, line_id, *_]:
+                        self._line(line_id)
+                        del self.lines[line_id]
+                    case _:
+                        raise FakeOdooError(f"Unsupported line command {command}")
+            move.update({key: value for key, value in vals.items() if key != 'line_ids'})
+            self._check_balanced(move_id)
+        return True
+
+    def _account_move_unlink(self, ids: list[int]) -> bool:
+        for move_id in ids:
+            self._move(move_id)
+            del self.moves[move_id]
+            self.lines = {line_id: line for line_id, line in self.lines.items() if line['move_id'] != move_id}
+        return True
+
+    def _account_move_line_create(self, vals_list: list[dict]) -> list[int]:
+        line_ids = [self._create_line(vals) for vals in vals_list]
+        for move_id in {vals['move_id'] for vals in vals_list}:
+            self._check_balanced(move_id)
+        return line_ids
+
+    def _account_move_line_search_read(self, domain: list, fields: list = None) -> list[dict]:
+        lines = [self._line_record(line) for line in self.lines.values()]
+        return [_read(line, fields) for line in lines if _matches(line, domain)]
+
+    def _move(self, move_id: int) -> dict:
+        try:
+            return self.moves[move_id]
+        except KeyError:
+            raise FakeOdooError(f"Record account.move({move_id},) does not exist or has been deleted") from None
+
+    def _line(self, line_id: int) -> dict:
+        try:
+            return self.lines[line_id]
+        except KeyError:
+            raise FakeOdooError(f"Record account.move.line({line_id},) does not exist or has been deleted") from None
+
+    def _create_line(self, vals: dict) -> int:
+        self._move(vals['move_id'])
+        if vals.get('account_id') not in self.accounts:
+            raise FakeOdooError(f"Record account.account({vals.get('account_id')},) does not exist")
+        line_id = next(self._line_ids)
+        self.lines[line_id] = dict(vals, id=line_id)
+        return line_id
+
+    def _line_record(self, line: dict) -> dict:
+        """:returns a journal item as Odoo reads it back, with its computed fields"""
+
+        account = self.accounts[line['account_id']]
+        quantity = float(line.get('quantity', 1.0))
+        price_unit = float(line.get('price_unit', 0.0))
+
+        if line.get('exclude_from_invoice_tab'):
+            # The A/P offset is given as a credit
+            debit, credit = 0.0, float(line.get('credit', 0.0))
+        else:
+            amount = round(quantity * price_unit, 2)
+            debit, credit = max(amount, 0.0), max(-amount, 0.0)
+
+        return dict(line,
+                    name=line.get('name', False),
+                    account_id=[account['id'], f"{account['code']} {account['name']}"],
+                    quantity=quantity,
+                    price_unit=price_unit,
+                    debit=debit,
+                    credit=credit,
+                    balance=debit - credit,
+                    exclude_from_invoice_tab=bool(line.get('exclude_from_invoice_tab')))
+
+    def _check_balanced(self, move_id: int) -> None:
+        lines = [self._line_record(line) for line in self.lines.values() if line['move_id'] == move_id]
+        if abs(sum(line['balance'] for line in lines)) >= 0.005:
+            raise FakeOdooError("Cannot create unbalanced journal entry.")
+
+
+def _matches(record: dict, domain: list) -> bool:
+    """:returns whether a record matches a domain of ['field', '=', value] leaves"""
+
+    for field, operator, value in domain:
+        if operator != '=':
+            raise FakeOdooError(f"Operator {operator} is not supported by the fake Odoo server")
+        found = record.get(field, False)
+        # Many2one fields are matched on their id
+        if isinstance(found, list):
+            found = found[0]
+        if found != value:
+            return False
+    return True
+
+
+def _read(record: dict, fields: list = None) -> dict:
+    """:returns the requested fields of a record, Odoo always adds the id"""
+
+    return {'id': record['id'], **{field: record.get(field, False) for field in fields or record}}
+
+
+class FakeOdooRequestHandler(BaseHTTPRequestHandler):
+    """Odoo's /xmlrpc/2 and /jsonrpc endpoints, gzip compressed in both directions when asked"""
+
+    server: "FakeOdooServer"
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        if self.path == '/jsonrpc':
+            content_type, data = 'application/json', self._jsonrpc(body)
+        elif self.path in ('/xmlrpc/2/common', '/xmlrpc/2/object'):
+            content_type, data = 'text/xml', self._xmlrpc(self.path.rsplit('/', 1)[1], body)
+        else:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _call(self, service: str, method: str, args: list):
+        match service, method:
+            case 'common', 'authenticate':
+                return self.server.odoo.authenticate(*args)
+            case 'object', 'execute_kw':
+                return self.server.odoo.execute_kw(*args)
+        raise FakeOdooError(f"{service}.{method} is not supported by the fake Odoo server")
+
+    def _xmlrpc(self, service: str, body: bytes) -> bytes:
+        args, method = xmlrpc.client.loads(body, use_builtin_types=True)
+        try:
+            response = (self._call(service, method, list(args)),)
+        except FakeOdooError as e:
+            response = xmlrpc.client.Fault(1, str(e))
+        return xmlrpc.client.dumps(response, methodresponse=True, allow_none=True).encode()
+
+    def _jsonrpc(self, body: bytes) -> bytes:
+        request: dict = json.loads(body)
+        params: dict = request['params']
+        try:
+            response = {'result': self._call(params['service'], params['method'], params['args'])}
+        except FakeOdooError as e:
+            response = {'error': {'code': 200, 'message': 'Odoo Server Error', 'data': {'message': str(e)}}}
+        return json.dumps({'jsonrpc': '2.0', 'id': request.get('id'), **response}).encode()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeOdooServer(ThreadingHTTPServer):
+
+    def __init__(self, address: tuple, odoo: FakeOdoo):
+        """
+        :param address: (host, port) to listen on, port 0 picks a free one
+        :type address: tuple
+        :param odoo: the data the server answers from
+        :type odoo: FakeOdoo
+        """
+
+        super().__init__(address, FakeOdooRequestHandler)
+        self.odoo: FakeOdoo = odoo
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3.10
+import argparse
+import json
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.parser import BytesParser
+from email.policy import HTTP
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from prupload import OdooSession, PayrollError, upload
+
+
+class Job:
+    """One uploaded payroll file and the outcome of importing it"""
+
+    def __init__(self, filename: str, data: bytes):
+        self.id: str = uuid.uuid4().hex
+        self.filename: str = filename
+        self.data: bytes = data
+        self.status: str = "queued"  # queued -> running -> done | failed
+        self.ref: str = ''
+        self.move_id: int = 0  # Odoo vendor bill id
+        self.error: str = ''
+        self.submitted: float = time.time()
+        self.seconds: float = 0.0  # time spent importing
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self, session: OdooSession) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'ref': self.ref,
+            'move_id': self.move_id,
+            'url': session.bill_url(self.move_id) if self.move_id else '',
+            'error': self.error,
+            'seconds': round(self.seconds, 3),
+        }
+
+
+class PayrollQueue:
+    """
+    Bounded queue of uploaded payroll files, imported by a fixed pool of worker threads.
+    The workers share one logged in OdooSession, so the uid and account ids are only looked up once.
+    """
+
+    def __init__(self, session: OdooSession, workers: int = 4, queue_size: int = 32, keep: int = 1000):
+        """
+        :param session: server to create the vendor bills on
+        :type session: OdooSession
+        :param workers: number of files imported at the same time
+        :type workers: int
+        :param queue_size: number of files that may wait for a worker before uploads are refused
+        :type queue_size: int
+        :param keep: number of jobs remembered for status polling
+        :type keep: int
+        """
+
+        self.session: OdooSession = session
+        self.workers: int = workers
+        self.keep: int = keep
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        """Log in to Odoo and start the workers"""
+
+        if not self.session.uid:
+            self.session.connect()
+
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"payroll-worker-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Let the workers finish the queued files, then stop them"""
+
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, filename: str, data: bytes) -> Job:
+        """
+        Queue a payroll file for import
+        :raises queue.Full: if the queue is full
+        :rtype: Job
+        """
+
+        job = Job(filename, data)
+        with self._lock:
+            self._queue.put_nowait(job)
+            self._jobs[job.id] = job
+
+            # Forget the oldest finished jobs
+            for job_id in list(self._jobs)[:max(len(self._jobs) - self.keep, 0)]:
+                if self._jobs[job_id].finished:
+                    del self._jobs[job_id]
+        return job
+
+    def get(self, job_id: str):
+        """:returns Job or None if the id is unknown"""
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self) -> None:
+        while (job := self._queue.get()) is not None:
+            job.status = "running"
+            start = time.perf_counter()
+            try:
+                bill = upload(job.data, job.filename, self.session)
+                job.ref = bill.ref
+                job.move_id = bill.id
+                job.status = "done"
+            except PayrollError as e:
+                job.error = str(e)
+                job.status = "failed"
+            except Exception as e:
+                job.error = repr(e)
+                job.status = "failed"
+            finally:
+                job.seconds = time.perf_counter() - start
+                job.data = b''
+                self._queue.task_done()
+
+
+def _read_upload(content_type: str, body: bytes) -> tuple[str, bytes]:
+    """:returns (filename, contents) of the first file in a multipart/form-data request body"""
+
+    message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    if not message.is_multipart():
+        raise ValueError("Expected a multipart/form-data upload")
+
+    for part in message.iter_parts():
+        filename = part.get_filename()
+        if filename:
+            # Only the name matters (CSV files are recognised by it), never trust a path from the client
+            return Path(filename).name, part.get_payload(decode=True)
+
+    raise ValueError("The upload does not contain a file")
+
+
+class PayrollRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs       multipart/form-data payroll file -> 202 and the queued job
+    GET  /jobs/<id>  status of a job, with the Odoo vendor bill id and link once it is done
+    """
+
+    server: "PayrollHTTPServer"
+    job_path = re.compile(r'^/jobs/([0-9a-f]{32})$')
+
+    def do_POST(self) -> None:
+        if self.path.rstrip('/') != '/jobs':
+            return self._send_json(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+
+        if self.headers.get('Content-Length') is None:
+            return self._send_json(HTTPStatus.LENGTH_REQUIRED, {'error': 'Content-Length is required'})
+        try:
+            length = int(self.headers['Content-Length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._send_json(HTTPStatus.BAD_REQUEST, {'error': 'Content-Length must be a whole number of bytes'})
+        if length > self.server.max_upload:
+            return self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'Payroll file is too large'})
+
+        try:
+            filename, data = _read_upload(self.headers.get('Content-Type', ''), self.rfile.read(length))
+        except ValueError as e:
+            return self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+
+        try:
+            job = self.server.payroll_queue.submit(filename, data)
+        except queue.Full:
+            return self._send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'Too many payroll files queued, retry later'})
+
+        self._send_json(HTTPStatus.ACCEPTED, job.to_dict(self.server.payroll_queue.session),
+                        location=f"/jobs/{job.id}")
+
+    def do_GET(self) -> None:
+        match = self.job_path.match(self.path)
+        job = self.server.payroll_queue.get(match.group(1)) if match else None
+        if job is None:
+            return self._send_json(HTTPStatus.NOT_FOUND, {'error': 'No such job'})
+
+        self._send_json(HTTPStatus.OK, job.to_dict(self.server.payroll_queue.session))
+
+    def _send_json(self, status: HTTPStatus, body: dict, location: str = '') -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if location:
+            self.send_header('Location', location)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class PayrollHTTPServer(ThreadingHTTPServer):
+
+    def __init__(self, address: tuple, payroll_queue: PayrollQueue, max_upload: int = 10 * 1024 * 1024):
+        """
+        :param address: (host, port) to listen on
+        :type address: tuple
+        :param payroll_queue: started queue that imports the uploaded files
+        :type payroll_queue: PayrollQueue
+        :param max_upload: largest accepted request body in bytes
+        :type max_upload: int
+        """
+
+        super().__init__(address, PayrollRequestHandler)
+        self.payroll_queue: PayrollQueue = payroll_queue
+        self.max_upload: int = max_upload
+
+
+def main():
+    parser = argparse.ArgumentParser(conflict_handler='resolve',
+                                     description='Accept ADP payroll file uploads over HTTP and import them into '
+                                                 'Odoo as vendor bills'
+                                     )
+    parser.add_argument('-c', '--config', dest='configfile', type=str, required=False,
+                        default='/usr/local/etc/prupload.conf',
+                        help='specify a different config file (default "/usr/local/etc/prupload.conf")')
+    parser.add_argument('-s', '--server', dest='server', type=str, required=False, default='odoo',
+                        help='specify a different server config to use from config file (default "odoo")')
+    parser.add_argument('--host', dest='host', type=str, required=False, default='127.0.0.1',
+                        help='address to listen on (default "127.0.0.1")')
+    parser.add_argument('-p', '--port', dest='port', type=int, required=False, default=8080,
+                        help='port to listen on (default 8080)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, required=False, default=4,
+                        help='number of payroll files imported at the same time (default 4)')
+    parser.add_argument('-q', '--queue-size', dest='queue_size', type=int, required=False, default=32,
+                        help='number of payroll files that may wait for a worker (default 32)')
+
+    args = parser.parse_args()
+
+    try:
+        session = OdooSession.from_config_file(args.configfile, args.server)
+        payroll_queue = PayrollQueue(session, workers=args.workers, queue_size=args.queue_size)
+        payroll_queue.start()
+    except (OSError, PayrollError) as e:
+        print(f"{e}. Exiting.", file=sys.stderr)
+        sys.exit(1)
+
+    with PayrollHTTPServer((args.host, args.port), payroll_queue) as httpd:
+        print(f"Accepting payroll files for {session.server} on http://{args.host}:{args.port}/jobs")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    payroll_queue.stop()
+
+
+if __name__ == '__main__':
+    main()
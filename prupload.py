@@ -1,17 +1,26 @@
 #!/usr/bin/env python3.10
 import argparse
+import copy
 import csv
+import gzip
+import http.client
+import itertools
+import json
 import math
 import re
 import ssl
 import sys
+import threading
+import time
+import urllib.parse
 import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from io import StringIO
+from operator import itemgetter
 from pathlib import Path
 from typing import io
 
-import prupload
-
 try:
     import xlrd
     from xlrd import open_workbook, xldate_as_tuple
@@ -43,43 +52,346 @@ if sys.platform == "darwin":
     except ImportError:
         print("If you would like to tag files as done, install the macos-tags library via pip")
 
-## NOTE global vars are here for test suite - they are overridden in main()
-try:
-    with open('config.yaml') as f:
-        config = yaml.safe_load(f)
-
-    # Set default server config to test server
-    server = "odoo-dev"
-
-    # get login info from the config file
-    url = config[server]['url']
-    db = config[server]['database']
-    username = config[server]['username']
-    password = config[server]['password']
-
-    # get uid of user
-    with xmlrpc.client.ServerProxy(f"{url}/xmlrpc/2/common", allow_none=True,
-                                   context=ssl._create_unverified_context()) as common:
-        uid = common.authenticate(db, username, password, {})
-
-    with xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True,
-                                   context=ssl._create_unverified_context()) as models:
-        code_ids = models.execute_kw(db, uid, password, 'account.account', 'search_read',
-                                     [[['deprecated', '=', False]]],
-                                     {'fields': ['code', 'id']}
-                                     )
-    code_ids = {rec['code']: rec['id'] for rec in code_ids}
 
-    # Cleanup
-    del (common)
-    del (models)
+class PayrollError(Exception):
+    """Base class for everything that can go wrong turning a payroll file into an Odoo vendor bill"""
+
+
+class PayrollFileError(PayrollError):
+    """The file is not an ADP payroll file we know how to read"""
+
+
+class UnbalancedBillError(PayrollError):
+    """The payroll lines do not add up to the total stated in the file"""
+
+
+class UnknownDepartmentError(PayrollError):
+    """A payroll line belongs to a department that is missing from the config file"""
+
+
+class OdooError(PayrollError):
+    """The Odoo server refused the login or the request"""
+
+
+class OdooTransport:
+    """Sends RPC calls to an Odoo server. Subclasses implement call()"""
+
+    name: str = ''
+    url: str = ''
+
+    def authenticate(self, db: str, username: str, password: str) -> int:
+        return self.call('common', 'authenticate', [db, username, password, {}])
+
+    def execute_kw(self, db: str, uid: int, password: str, model: str, method: str, args: list, kwargs: dict):
+        return self.call('object', 'execute_kw', [db, uid, password, model, method, args, kwargs])
+
+    def call(self, service: str, method: str, args: list):
+        """Call a method of one of Odoo's RPC services ("common" or "object")"""
+        raise NotImplementedError
+
+
+class HTTPTransport(OdooTransport):
+    """
+    Subclasses decide how calls are encoded, this class posts them over a kept alive HTTP connection
+    per thread, optionally gzip compressed. Safe to share between threads.
+    """
+
+    content_type: str = ''
+
+    def __init__(self, url: str, compress: bool = False):
+        """
+        :param url: base url of the Odoo server
+        :type url: str
+        :param compress: gzip request bodies. The server, or the proxy in front of it, must accept them
+        :type compress: bool
+        """
+
+        parts = urllib.parse.urlsplit(url)
+        self.url: str = url
+        self.compress: bool = compress
+        self._https: bool = parts.scheme == 'https'
+        self._host: str = parts.netloc
+        self._prefix: str = parts.path.rstrip('/')
+        self._local = threading.local()
+
+    def call(self, service: str, method: str, args: list):
+        return self.decode_response(self._post(self.path(service), self.request_body(service, method, args)))
+
+    def path(self, service: str) -> str:
+        raise NotImplementedError
+
+    def encode_request(self, service: str, method: str, args: list) -> bytes:
+        raise NotImplementedError
+
+    def decode_response(self, data: bytes):
+        """:returns the result of the call, raising OdooError if the server sent back an error"""
+        raise NotImplementedError
+
+    def request_body(self, service: str, method: str, args: list) -> bytes:
+        """:returns the request body exactly as it is sent to the server"""
+
+        body = self.encode_request(service, method, args)
+        return gzip.compress(body, compresslevel=5) if self.compress else body
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._https:
+            return http.client.HTTPSConnection(self._host, context=ssl._create_unverified_context())
+        return http.client.HTTPConnection(self._host)
+
+    def _post(self, path: str, body: bytes) -> bytes:
+        headers = {'Content-Type': self.content_type, 'Accept-Encoding': 'gzip'}
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+
+        # Like xmlrpc.client, retry once if the server closed the kept alive connection
+        for attempt in (0, 1):
+            connection = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+            except Exception:
+                connection.close()
+                self._local.connection = None
+                raise
+
+        if response.status != 200:
+            raise OdooError(f"{self.url}{path} answered {response.status} {response.reason}")
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return data
+
+
+class XMLRPCTransport(HTTPTransport):
+    """Odoo's /xmlrpc/2 endpoints"""
+
+    name = 'xmlrpc'
+    content_type = 'text/xml'
+
+    def path(self, service: str) -> str:
+        return f"{self._prefix}/xmlrpc/2/{service}"
+
+    def encode_request(self, service: str, method: str, args: list) -> bytes:
+        return xmlrpc.client.dumps(tuple(args), method, allow_none=True).encode('utf-8', 'xmlcharrefreplace')
+
+    def decode_response(self, data: bytes):
+        try:
+            return xmlrpc.client.loads(data)[0][0]
+        except xmlrpc.client.Fault as e:
+            raise OdooError(e.faultString) from e
+
+
+class JSONRPCTransport(HTTPTransport):
+    """Odoo's /jsonrpc endpoint, smaller and quicker to build and parse than XML-RPC"""
+
+    name = 'jsonrpc'
+    content_type = 'application/json'
+
+    def __init__(self, url: str, compress: bool = False):
+        super().__init__(url, compress)
+        self._ids = itertools.count(1)
+
+    def path(self, service: str) -> str:
+        return f"{self._prefix}/jsonrpc"
+
+    def encode_request(self, service: str, method: str, args: list) -> bytes:
+        return json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': service, 'method': method, 'args': args},
+            'id': next(self._ids),
+        }, separators=(',', ':')).encode()
+
+    def decode_response(self, data: bytes):
+        response: dict = json.loads(data)
+        if 'error' in response:
+            error: dict = response['error']
+            raise OdooError((error.get('data') or {}).get('message') or error.get('message', 'Unknown error'))
+        return response['result']
+
+
+class CassetteMismatch(AssertionError):
+    """A replayed call differs from the one recorded in the cassette"""
+
+
+def _cassette_request(service: str, method: str, args: list) -> dict:
+    """:returns a call as stored in a cassette: JSON types only and without the password"""
+
+    args = json.loads(json.dumps(args))
+    # authenticate and execute_kw both take the password as third argument
+    if method in ('authenticate', 'execute_kw'):
+        args[2] = '********'
+    return {'service': service, 'method': method, 'args': args}
+
+
+class RecordingTransport(OdooTransport):
+    """Passes calls on to another transport and keeps them in a cassette file, for ReplayTransport"""
+
+    name = 'record'
+
+    def __init__(self, transport: OdooTransport, cassette: str):
+        """
+        :param transport: transport that talks to the real server
+        :type transport: OdooTransport
+        :param cassette: JSON file the calls are written to by save()
+        :type cassette: str
+        """
+
+        self.url: str = transport.url
+        self.transport: OdooTransport = transport
+        self.cassette: Path = Path(cassette)
+        self.interactions: list[dict] = []
+        self._lock = threading.Lock()
+
+    def call(self, service: str, method: str, args: list):
+        interaction = {'request': _cassette_request(service, method, args)}
+        try:
+            interaction['result'] = self.transport.call(service, method, args)
+        except OdooError as e:
+            interaction['error'] = str(e)
+            raise
+        finally:
+            # Calls that never got an answer, e.g. connection errors, are not recorded
+            if len(interaction) > 1:
+                with self._lock:
+                    self.interactions.append(interaction)
+        return interaction['result']
+
+    def save(self) -> None:
+        self.cassette.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cassette, 'w') as f:
+            json.dump({'interactions': self.interactions}, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+
+class ReplayTransport(OdooTransport):
+    """
+    Serves the calls of a cassette recorded by RecordingTransport back in order, without a server.
+    Each call has to match the recorded one exactly, so changes to what is sent to Odoo are caught.
+    """
+
+    name = 'replay'
+
+    def __init__(self, cassette: str):
+        with open(cassette) as f:
+            self.interactions: list[dict] = json.load(f)['interactions']
+
+        self.url: str = str(cassette)
+        self.cassette: str = str(cassette)
+        self._played: int = 0
+        self._lock = threading.Lock()
+
+    def call(self, service: str, method: str, args: list):
+        request = _cassette_request(service, method, args)
+
+        with self._lock:
+            if self._played >= len(self.interactions):
+                raise CassetteMismatch(f"{self.cassette}: unexpected call {request}")
+            interaction = self.interactions[self._played]
+            self._played += 1
+
+        if interaction['request'] != request:
+            raise CassetteMismatch(f"{self.cassette}: call {self._played} differs from the recording\n"
+                                   f"recorded: {interaction['request']}\nsent:     {request}")
+        if 'error' in interaction:
+            raise OdooError(interaction['error'])
+        return interaction['result']
+
+    def assert_finished(self) -> None:
+        """Fail if calls from the cassette were never made"""
+
+        if self._played != len(self.interactions):
+            raise CassetteMismatch(f"{self.cassette}: only {self._played} of {len(self.interactions)} "
+                                   f"recorded calls were made")
+
+
+# Values of the transport setting of a server block in the config file
+TRANSPORTS: dict[str, type] = {transport.name: transport for transport in (XMLRPCTransport, JSONRPCTransport)}
+
+
+class OdooSession:
+    """
+    Everything needed to talk to one Odoo server: the loaded config, the login details of one of
+    its server blocks, and cached lookups (uid, account code ids). Safe to share between threads.
+    """
+
+    def __init__(self, config: dict, server: str = "odoo"):
+        """
+        :param config: the loaded config file
+        :type config: dict
+        :param server: name of the server block in the config file, e.g. "odoo-dev"
+        :type server: str
+        """
+
+        try:
+            server_config: dict = config[server]
+        except KeyError:
+            raise PayrollError(f"The server {server} does not exist in the config file")
+
+        # Without partner and journal Odoo would happily create a vendor bill with no vendor
+        for key in ('url', 'database', 'username', 'password', 'partner-id', 'journal-id'):
+            if key not in server_config:
+                raise PayrollError(f"The server {server} has no {key} in the config file")
+
+        self.config: dict = config
+        self.server: str = server
+        self.url: str = server_config['url']
+        self.db: str = server_config['database']
+        self.username: str = server_config['username']
+        self.password: str = server_config['password']
+        self.partner_id: int = server_config['partner-id']
+        self.journal_id: int = server_config['journal-id']
+
+        transport: str = server_config.get('transport', XMLRPCTransport.name)
+        if transport not in TRANSPORTS:
+            raise PayrollError(f"Unknown transport {transport} for server {server}, use one of {', '.join(TRANSPORTS)}")
+        self.transport: OdooTransport = TRANSPORTS[transport](self.url, compress=server_config.get('compress', False))
+
+        self.uid: int = 0
+        self.code_ids: dict[str, int] = {}
+
+    @classmethod
+    def from_config_file(cls, filename: str, server: str = "odoo"):
+        """:returns OdooSession for a server block of a YAML config file"""
+
+        with open(filename) as f:
+            return cls(yaml.safe_load(f), server)
+
+    def connect(self) -> None:
+        """Authenticate against the server and cache the ids of all active account codes"""
 
-except FileNotFoundError:
-    # if we're here, the test config file can not be found, which is okay
-    pass
+        uid = self.transport.authenticate(self.db, self.username, self.password)
 
+        if not uid:
+            raise OdooError(f"Login to {self.server} as {self.username} failed")
+        self.uid = uid
+
+        codes = self.execute_kw('account.account', 'search_read',
+                                [[['deprecated', '=', False]]],
+                                {'fields': ['code', 'id']}
+                                )
+        self.code_ids = {rec['code']: rec['id'] for rec in codes}
+
+    def execute_kw(self, model: str, method: str, args: list, kwargs: dict = None):
+        """Call a method on an Odoo model as the authenticated user"""
+
+        try:
+            return self.transport.execute_kw(self.db, self.uid, self.password, model, method, args, kwargs or {})
+        except OdooError as e:
+            raise OdooError(f"{self.server}: {model}.{method} failed: {e}") from e
+
+    def bill_url(self, bill_id: int) -> str:
+        """Link to the vendor bill form in the Odoo web client"""
+        return f"{self.url}/web#id={bill_id}&cids=1&menu_id=240&action=1237&model=account.move&view_type=form"
 
-# END test global variables
 
 def _clean_file(infile: io.TextIO) -> list[str]:
     """Remove extra spaces from the ADP file that make csv.DictReader sad"""
@@ -92,6 +404,118 @@ def _clean_file(infile: io.TextIO) -> list[str]:
     return [junk.sub(r'",', line) for line in infile]
 
 
+def _config_value(config: dict, *keys):
+    """:returns a nested config file entry, e.g. _config_value(config, 'accounts', 'expenses', 'health')"""
+
+    value = config
+    for n, key in enumerate(keys, 1):
+        try:
+            value = value[key]
+        except (KeyError, TypeError):
+            raise PayrollError(f"The config file has no {'/'.join(map(str, keys[:n]))} entry") from None
+    return value
+
+
+# Source columns of each PayrollBillLine field, per payroll file layout. A column name is read as is and must
+# be in the file. A list of column names is summed, and columns missing from the file count as zero, as ADP
+# leaves out adjustment columns nobody used that week. Overridden per layout by column-schemas in the config file.
+DEFAULT_COLUMN_SCHEMAS: dict[str, dict] = {
+    'excel': {
+        'total': 'TOTAL',
+        'department': 'DEPARTMENT NUMBER',
+        'earnings': 'GROSS',
+        'fees': ['TOTAL SVC FEE AMT', 'ADJ NYMT-NY METRO', 'TLM SUBTOTAL'],
+        'deductions': ['ADJ 75-AFLAC POST-TAX', 'ADJ 74-AFLAC PRETAX', 'ADJ 31-MEDICAL', 'ADJ 33-TS DENTAL',
+                       'ADJ 34-VISION'],
+        'retirement': ['ADJ ER401K-401K MATCH'],
+    },
+    'csv': {
+        'total': 'Total Payroll Bill',
+        'description': 'Dept Descr',
+        'department': 'Worked Department #',
+        'earnings': 'Gross Earnings',
+        'fees': 'Total Fee',
+        'deductions': 'Deduct Adjust',
+        'retirement': 'Employer Contrib (401k)',
+    },
+}
+
+# PayrollBillLine constructor arguments, in order, and their value when a schema does not map them
+LINE_FIELDS: tuple = (('total', 0.0), ('description', ''), ('department', 0), ('earnings', 0.0), ('fees', 0.0),
+                      ('deductions', 0.0), ('retirement', 0.0))
+
+
+def column_schema(config: dict, layout: str) -> dict:
+    """:returns the column schema of a payroll file layout ("excel" or "csv"), config file entries first"""
+
+    schema: dict = dict(DEFAULT_COLUMN_SCHEMAS[layout])
+    schema.update((config.get('column-schemas') or {}).get(layout) or {})
+
+    unknown = set(schema) - {field for field, _ in LINE_FIELDS}
+    if unknown:
+        raise PayrollError(f"Unknown payroll line fields in the {layout} column schema: {', '.join(sorted(unknown))}")
+    return schema
+
+
+def _cell_float(value) -> float:
+    """Blank and non-numeric cells count as zero"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def compile_line_extractor(schema: dict, header: list, config: dict):
+    """
+    Resolve a column schema against the header row of a payroll file once, so each row is turned into a
+    PayrollBillLine by index, without building a dict per row.
+    :param schema: column schema, see DEFAULT_COLUMN_SCHEMAS
+    :type schema: dict
+    :param header: column names of the file
+    :type header: list
+    :param config: the loaded config file, handed to each PayrollBillLine
+    :type config: dict
+    :returns: function of a raw row (list or tuple of cell values) that returns a PayrollBillLine
+    :rtype: Callable
+    """
+
+    index: dict[str, int] = {}
+    for i, name in enumerate(header):
+        index.setdefault(str(name).strip(), i)
+
+    getters: list = []
+    for field, default in LINE_FIELDS:
+        columns = schema.get(field)
+
+        if columns is None:
+            getters.append(lambda row, default=default: default)
+
+        elif isinstance(columns, str):
+            if columns not in index:
+                raise PayrollFileError(f"The payroll file has no {columns} column")
+            getters.append(itemgetter(index[columns]))
+
+        else:
+            indices = [index[column] for column in columns if column in index]
+            if not indices:
+                getters.append(lambda row: 0.0)
+            elif len(indices) == 1:
+                getters.append(lambda row, i=indices[0]: _cell_float(row[i]))
+            else:
+                getters.append(lambda row, get=itemgetter(*indices): sum(map(_cell_float, get(row))))
+
+    return lambda row: PayrollBillLine(*[get(row) for get in getters], config=config)
+
+
+def _server_list(servers: str) -> list[str]:
+    """argparse type for -s/--server: "odoo,odoo-dev" -> ["odoo", "odoo-dev"]. Each server is listed once,
+    results are reported per server name"""
+    names = list(dict.fromkeys(name.strip() for name in servers.split(',') if name.strip()))
+    if not names:
+        raise argparse.ArgumentTypeError(f"no server names in {servers!r}")
+    return names
+
+
 class PayrollBill:
     def __init__(self):
 
@@ -127,29 +551,21 @@ class PayrollBill:
             return 0.0
 
     @classmethod
-    def load(cls, infile: io.TextIO):
+    def load(cls, infile: io.TextIO, config: dict):
+        """:returns PayrollBill object from an open payroll file"""
 
         try:
-            mime_type = magic.from_file(infile.name, mime=True)
-
-            if mime_type == 'application/vnd.ms-excel':
-                i: prupload.PayrollBill = cls._load_xl(infile)
-                i.source_file_type = "excel"
-                return i
-
-            elif mime_type == 'text/plain' and infile.name.endswith('.csv'):
-                i: prupload.PayrollBill = cls._load_csv(infile)
-                i.source_file_type = "csv"
-                return i
-        except:
-            print("The file is neither an Excel file nor a CSV, is not a payroll bill, or can not be read. Exiting.",
-                  file=sys.stderr)
-            sys.exit(1)
+            with open(infile.name, 'rb') as f:
+                data: bytes = f.read()
+        except OSError as e:
+            raise PayrollFileError(f"Can not read payroll file {infile.name}: {e}") from e
+
+        return parse_payroll(data, infile.name, config)
 
     @classmethod
-    def _load_xl(cls, infile: io.TextIO) -> object:
+    def _load_xl(cls, data: bytes, filename: str, config: dict) -> object:
 
-        xl_file: XLPayrollFile = XLPayrollFile(filename=infile.name, load=True)
+        xl_file: XLPayrollFile = XLPayrollFile(filename=filename, config=config, contents=data, load=True)
 
         # Create a new PayrollBill object
         bill = PayrollBill()
@@ -161,138 +577,311 @@ class PayrollBill:
         bill.ref = xl_file.header_data['reference']
 
         # Add payroll lines to payroll bill
-        for line in xl_file.pay_data:
-            # Add medical deductions. Some could be empty strings which need to be zero
-            medical: float = 0
-            medical += line['ADJ 75-AFLAC POST-TAX'] or 0.0
-            medical += line['ADJ 74-AFLAC PRETAX'] or 0.0
-            medical += line['ADJ 31-MEDICAL'] or 0.0
-            medical += line['ADJ 33-TS DENTAL'] or 0.0
-            medical += line['ADJ 34-VISION'] or 0.0
-
-            # Same with fees
-            fees: float = 0
-            fees += line['TOTAL SVC FEE AMT'] or 0.0
-            fees += line['ADJ NYMT-NY METRO'] or 0.0
-            fees += line['TLM SUBTOTAL'] or 0.0
-            bill.payroll_lines.append(
-                PayrollBillLine(
-                    total=line['TOTAL'],
-                    department=int(line['DEPARTMENT NUMBER']),
-                    earnings=line['GROSS'],
-                    fees=fees,
-                    deductions=medical,
-                    retirement=line['ADJ ER401K-401K MATCH']
-                )
-            )
+        extract = compile_line_extractor(column_schema(config, 'excel'), xl_file.pay_columns, config)
+        bill.payroll_lines = [extract(row) for row in xl_file.pay_data]
         return bill
 
     @classmethod
-    def _load_csv(cls, infile: io.TextIO) -> object:
+    def _load_csv(cls, data: bytes, config: dict) -> object:
         """:returns PayrollBill object from file with data loaded"""
 
-        infile = _clean_file(infile)
-        pr_csv = csv.DictReader(infile, dialect='unix', quoting=csv.QUOTE_ALL)
+        infile = _clean_file(StringIO(data.decode(), newline=''))
+        pr_csv = csv.reader(infile, dialect='unix', quoting=csv.QUOTE_ALL)
 
         # slurp all lines to make life easy
-        payroll_lines: list[dict] = [x for x in pr_csv]
-        line: dict = payroll_lines[0]
+        header: list[str] = [column.strip() for column in next(pr_csv)]
+        payroll_lines: list[list] = [x for x in pr_csv]
+
+        # Fee only lines stop after the totals, pad them like csv.DictReader would
+        width = len(header)
+        for row in payroll_lines:
+            if len(row) < width:
+                row.extend([''] * (width - len(row)))
+
+        line: list = payroll_lines[0]
+        column = lambda name: line[header.index(name)] if name in header else ""
 
         # Create a new PayrollBill object
         bill = PayrollBill()
 
-        bd: str = line.get("Period End Date", "")
+        bd: str = column("Period End Date")
         bill.date = dateutil.parser.parse(bd).date()
 
-        dd: str = line.get("Check Date", "")
+        dd: str = column("Check Date")
         bill.due_date = dateutil.parser.parse(dd).date()
 
-        bill.ref = line.get("Paygroup", "") + '-20' + line.get("Report Year", "") + "-W" + \
-                   line.get("Week #", "") + '-' + line.get("Payroll #", "")
+        bill.ref = column("Paygroup") + '-20' + column("Report Year") + "-W" + \
+                   column("Week #") + '-' + column("Payroll #")
 
         # Add payroll lines to payroll bill
-        for line in payroll_lines:
-            bill.payroll_lines.append(
-                PayrollBillLine(
-                    description=line['Dept Descr'],
-                    total=line['Total Payroll Bill'],
-                    department=line['Worked Department #'],
-                    earnings=line['Gross Earnings'],
-                    fees=line['Total Fee'],
-                    deductions=line['Deduct Adjust'],
-                    retirement=line['Employer Contrib (401k)']
-                )
-            )
+        extract = compile_line_extractor(column_schema(config, 'csv'), header, config)
+        bill.payroll_lines = [extract(row) for row in payroll_lines]
         return bill
 
     @classmethod
-    def save(cls, bill) -> int:
+    def save(cls, bill, session: OdooSession) -> int:
         """Creates vendor bill in Odoo.
         :type bill: PayrollBill
+        :param session: connected session of the server to create the bill on
+        :type session: OdooSession
         :returns object id: int"""
 
         # Make sure the total from the Excel file matches totalling up the lines. This is a
         # noop for CSV files (no total in the file)
         if not bill.is_balanced:
-            print("Payroll lines do not match total. Exiting.", file=sys.stderr)
-            sys.exit(1)
-
-        # Values needed to create vendor bill in Odoo
-        vals = {
-            'move_type': 'in_invoice',
-            'partner_id': config[server]['partner-id'],
-            'date': bill.date.isoformat(),
-            'invoice_date': bill.date.isoformat(),
-            'invoice_date_due': bill.due_date.isoformat(),
-            'ref': bill.ref,
-            'journal_id': config[server]['journal-id'],
-        }
+            raise UnbalancedBillError(f"Payroll lines ({bill.invoice_total}) do not match total ({bill.file_total})")
+
+        # Build all values before creating anything, so a bad department can't leave an empty bill behind
+        line_vals: list[dict] = bill_to_line_values(bill, 0, session.code_ids)
 
         # Create vendor bill in Odoo
-        with xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True,
-                                       context=ssl._create_unverified_context()) as models:
-            bill.id = models.execute_kw(db, uid, password, 'account.move', 'create', [vals])
-
-            # Iterate through payroll lines, creating a list of dicts for easy loading in Odoo
-            vals = []
-            total: float = 0.0
-            for pr_line in bill.payroll_lines:
-                vals.extend(pr_line.to_odoo_values(bill.id))
-                total += pr_line.total
-
-            # Add offsetting journal item for A/P
-            vals.append(
-                {
-                    'move_id': bill.id,
-                    'account_id': code_ids["20100"],
-                    'credit': round(total,2),
-                    'exclude_from_invoice_tab': True
-                }
-            )
-            # with open(f"{bill.ref}.csv", 'w', newline='') as outfile:
-            #     fieldnames = [
-            #         'account_id',
-            #         'exclude_from_invoice_tab',
-            #         'move_id',
-            #         'name',
-            #         'price_unit',
-            #         'quantity',
-            #         'credit',
-            #     ]
-            #     writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            #
-            #     writer.writeheader()
-            #     writer.writerows(vals)
-
-            models.execute_kw(db, uid, password, 'account.move.line', 'create', [vals])
-        return bill.id
+        bill_id = session.execute_kw('account.move', 'create',
+                                     [bill_to_move_values(bill, session.partner_id, session.journal_id)])
+        bill.id = bill_id
+
+        for vals in line_vals:
+            vals['move_id'] = bill_id
+
+        session.execute_kw('account.move.line', 'create', [line_vals])
+        return bill_id
+
+    @classmethod
+    def update(cls, bill, session: OdooSession) -> int:
+        """Brings the existing draft vendor bill with the same reference in line with a corrected payroll file.
+        Only journal items that changed are sent to Odoo, in a single write.
+        :type bill: PayrollBill
+        :param session: connected session of the server the bill is on
+        :type session: OdooSession
+        :returns object id: int"""
+
+        if not bill.is_balanced:
+            raise UnbalancedBillError(f"Payroll lines ({bill.invoice_total}) do not match total ({bill.file_total})")
+
+        moves = session.execute_kw('account.move', 'search_read',
+                                   [[['ref', '=', bill.ref], ['move_type', '=', 'in_invoice'],
+                                     ['partner_id', '=', session.partner_id], ['state', '=', 'draft']]],
+                                   {'fields': ['id'], 'limit': 2}
+                                   )
+        if len(moves) != 1:
+            raise PayrollError(f"Expected one draft vendor bill with reference {bill.ref} on {session.server}, "
+                               f"found {len(moves)}")
+        bill_id = moves[0]['id']
+        bill.id = bill_id
+
+        existing = session.execute_kw('account.move.line', 'search_read',
+                                      [[['move_id', '=', bill_id]]],
+                                      {'fields': list(MOVE_LINE_FIELDS)}
+                                      )
+        line_commands, offset_commands = diff_move_lines(existing,
+                                                         bill_to_line_values(bill, bill_id, session.code_ids),
+                                                         _account_id(session.code_ids, "20100"))
+
+        # Odoo checks the bill balances after each write, so the A/P offset goes in the same write as the lines
+        if line_commands or offset_commands:
+            session.execute_kw('account.move', 'write', [[bill_id], {'line_ids': line_commands + offset_commands}])
+        return bill_id
+
+    @classmethod
+    def save_all(cls, bill, sessions: list, update: bool = False) -> dict:
+        """Creates the same vendor bill on several Odoo servers concurrently.
+        :type bill: PayrollBill
+        :param sessions: one session per target server
+        :type sessions: list[OdooSession]
+        :param update: update the existing draft bills instead of creating new ones
+        :type update: bool
+        :returns: {server name: (bill id or exception, seconds taken)}. bill.id is left alone, each server
+            has its own id for the bill
+        :rtype: dict"""
+
+        save = cls.update if update else cls.save
+
+        def _save(session: OdooSession) -> tuple:
+            start = time.perf_counter()
+            try:
+                # Each server has its own uid and account ids, so log in if we haven't already
+                if not session.uid:
+                    session.connect()
+                # save() sets the id on the bill it is given, so every thread gets a copy of its own
+                result = save(copy.copy(bill), session)
+            except Exception as e:
+                result = e
+            return result, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=len(sessions) or 1) as executor:
+            results = executor.map(_save, sessions)
+            return {session.server: result for session, result in zip(sessions, results)}
+
+
+def parse_payroll(data: bytes, filename: str, config: dict) -> PayrollBill:
+    """
+    Turn the contents of an ADP payroll file into a PayrollBill. Does not touch the filesystem or Odoo.
+    :param data: raw file contents
+    :type data: bytes
+    :param filename: original file name, used to tell CSV files from other text
+    :type filename: str
+    :param config: the loaded config file
+    :type config: dict
+    :rtype: PayrollBill
+    """
+
+    mime_type = magic.from_buffer(data, mime=True)
+
+    try:
+        if mime_type == 'application/vnd.ms-excel':
+            bill: PayrollBill = PayrollBill._load_xl(data, filename, config)
+            bill.source_file_type = "excel"
+            return bill
+
+        elif mime_type == 'text/plain' and filename.endswith('.csv'):
+            bill: PayrollBill = PayrollBill._load_csv(data, config)
+            bill.source_file_type = "csv"
+            return bill
+
+    except PayrollError:
+        raise
+    except Exception as e:
+        raise PayrollFileError(f"{filename} is not a payroll bill or can not be read: {e!r}") from e
+
+    raise PayrollFileError(f"{filename} is neither an Excel file nor a CSV ({mime_type})")
+
+
+def bill_to_move_values(bill: PayrollBill, partner_id: int, journal_id: int) -> dict:
+    """:returns values needed to create the vendor bill (account.move) in Odoo"""
+
+    return {
+        'move_type': 'in_invoice',
+        'partner_id': partner_id,
+        'date': bill.date.isoformat(),
+        'invoice_date': bill.date.isoformat(),
+        'invoice_date_due': bill.due_date.isoformat(),
+        'ref': bill.ref,
+        'journal_id': journal_id,
+    }
+
+
+def bill_to_line_values(bill: PayrollBill, bill_id: int, code_ids: dict) -> list[dict]:
+    """:returns values needed to create the journal items (account.move.line) of the vendor bill in Odoo,
+    including the offsetting A/P item"""
+
+    # Iterate through payroll lines, creating a list of dicts for easy loading in Odoo
+    vals = []
+    total: float = 0.0
+    for pr_line in bill.payroll_lines:
+        vals.extend(pr_line.to_odoo_values(bill_id, code_ids))
+        total += pr_line.total
+
+    # Add offsetting journal item for A/P
+    vals.append(
+        {
+            'move_id': bill_id,
+            'account_id': _account_id(code_ids, "20100"),
+            'credit': round(total,2),
+            'exclude_from_invoice_tab': True
+        }
+    )
+    return vals
+
+
+def _account_id(code_ids: dict, code: str) -> int:
+    """:returns Odoo id of an account code"""
+
+    try:
+        return code_ids[code]
+    except KeyError:
+        raise PayrollError(f"Account code {code} does not exist in Odoo") from None
+
+
+# Journal item fields compared when updating an existing vendor bill
+MOVE_LINE_FIELDS = ('name', 'account_id', 'quantity', 'price_unit', 'credit', 'exclude_from_invoice_tab')
+
+
+def _changed_values(line: dict, vals: dict, fields: tuple) -> dict:
+    """:returns the fields of vals that differ from the journal item read from Odoo"""
+
+    changed = {}
+    for field in fields:
+        old = line.get(field)
+        # Many2one fields are read back as [id, display name]
+        if isinstance(old, list):
+            old = old[0]
+        if isinstance(vals[field], float):
+            if round(old or 0.0, 2) != round(vals[field], 2):
+                changed[field] = vals[field]
+        elif old != vals[field]:
+            changed[field] = vals[field]
+    return changed
+
+
+def diff_move_lines(existing: list[dict], new: list[dict], payable_account_id: int) -> tuple[list, list]:
+    """
+    Work out the Odoo line commands that turn the journal items of a vendor bill into new ones
+    :param existing: journal items read from Odoo, with at least the MOVE_LINE_FIELDS and id
+    :type existing: list[dict]
+    :param new: journal items as built by bill_to_line_values, A/P offset last
+    :type new: list[dict]
+    :param payable_account_id: Odoo id of the A/P account of the offset
+    :type payable_account_id: int
+    :returns: (create/update/delete commands for the invoice lines, command to fix the A/P offset)
+    :rtype: tuple[list, list]
+    """
+
+    # Invoice lines are matched on their name, which holds the department and the kind of amount
+    old_lines: dict[str, list[dict]] = {}
+    offset: dict = {}
+    for line in existing:
+        if not line['exclude_from_invoice_tab']:
+            old_lines.setdefault(line['name'], []).append(line)
+        elif line['account_id'] and line['account_id'][0] == payable_account_id:
+            offset = line
+
+    *new_lines, new_offset = new
+
+    line_commands: list = []
+    for vals in new_lines:
+        matches = old_lines.get(vals['name'])
+        if not matches:
+            line_commands.append((0, 0, {k: v for k, v in vals.items() if k != 'move_id'}))
+            continue
+
+        line = matches.pop(0)
+        changed = _changed_values(line, vals, ('account_id', 'quantity', 'price_unit'))
+        if changed:
+            line_commands.append((1, line['id'], changed))
+
+    # Anything left over is no longer on the payroll register
+    line_commands.extend((2, line['id']) for lines in old_lines.values() for line in lines)
+
+    if not offset:
+        offset_commands = [(0, 0, {k: v for k, v in new_offset.items() if k != 'move_id'})]
+    elif changed := _changed_values(offset, new_offset, ('credit',)):
+        offset_commands = [(1, offset['id'], changed)]
+    else:
+        offset_commands = []
+
+    return line_commands, offset_commands
+
+
+def upload(data: bytes, filename: str, session: OdooSession) -> PayrollBill:
+    """
+    Parse a payroll file and create its vendor bill in Odoo.
+    :returns PayrollBill with its Odoo id set
+    :rtype: PayrollBill
+    """
+
+    bill: PayrollBill = parse_payroll(data, filename, session.config)
+    if not session.uid:
+        session.connect()
+    PayrollBill.save(bill, session)
+    return bill
 
 
 class PayrollBillLine:
 
     def __init__(self, total: float, description: str = '', department=0, earnings=0.0, fees=0.0,
-                 deductions=0.0, retirement=0.0):
+                 deductions=0.0, retirement=0.0, config: dict = None):
 
+        # Department descriptions and account codes come from the config file
+        self.config: dict = config or {}
         self._description: str = description
         self.total: float = total
         self.department: int = department
@@ -312,7 +901,10 @@ class PayrollBillLine:
     @property
     def description(self) -> str:
         if not self._description and self.department:
-            self._description = config['department-descriptions'][self.department]
+            try:
+                self._description = _config_value(self.config, 'department-descriptions')[self.department]
+            except KeyError:
+                raise UnknownDepartmentError(f"The department {self.department} has no description in the config file")
 
         return self._description
 
@@ -391,29 +983,29 @@ class PayrollBillLine:
             case "earnings":
                 if self.is_fee_only is False:
                     try:
-                        return config['accounts']['departments'][self.department]
+                        return _config_value(self.config, 'accounts', 'departments')[self.department]
                     except KeyError:
-                        print(f"The department {self.department} does not exist in the config file", file=sys.stderr)
-                        sys.exit(1)
+                        raise UnknownDepartmentError(f"The department {self.department} does not exist in the config file")
                 return "not applicable"
             case "fees":
-                if self.department in config['direct-labor-departments']:
-                    return config['accounts']['expenses']['direct-labor']
+                if self.department in _config_value(self.config, 'direct-labor-departments'):
+                    return _config_value(self.config, 'accounts', 'expenses', 'direct-labor')
                 else:
-                    return config['accounts']['expenses']['payroll']
+                    return _config_value(self.config, 'accounts', 'expenses', 'payroll')
             case "deductions":
-                return config['accounts']['expenses']['health']
+                return _config_value(self.config, 'accounts', 'expenses', 'health')
             case "retirement":
-                return config['accounts']['expenses']['pension']
+                return _config_value(self.config, 'accounts', 'expenses', 'pension')
         return ""
 
-    def to_odoo_values(self, bill_id: int) -> list[dict]:
-        """Convert an ADP payroll line to Odoo dict format for creating journal items"""
+    def to_odoo_values(self, bill_id: int, code_ids: dict) -> list[dict]:
+        """Convert an ADP payroll line to Odoo dict format for creating journal items
+        :param code_ids: account code to id map of the target server"""
 
         # Create a line for fees
         fees = {
             'move_id': bill_id,
-            'account_id': code_ids[self.get_account_code("fees")],
+            'account_id': _account_id(code_ids, self.get_account_code("fees")),
             'name': f"{self.department} {self.description.title()} Payroll Fees",
             'quantity': 1,
             'price_unit': self.fees,
@@ -426,7 +1018,7 @@ class PayrollBillLine:
         # Create line for earnings
         earnings = {
             'move_id': bill_id,
-            'account_id': code_ids[self.get_account_code("earnings")],
+            'account_id': _account_id(code_ids, self.get_account_code("earnings")),
             'name': f"{self.department} {self.description.title()} Earnings",
             'quantity': 1,
             'price_unit': self.earnings,
@@ -436,7 +1028,7 @@ class PayrollBillLine:
         # Create a line for health deductions
         deductions = {
             'move_id': bill_id,
-            'account_id': code_ids[self.get_account_code("deductions")],
+            'account_id': _account_id(code_ids, self.get_account_code("deductions")),
             'name': f"{self.department} {self.description.title()} Health Deductions",
             'quantity': 1,
             'price_unit': self.deductions,
@@ -446,7 +1038,7 @@ class PayrollBillLine:
         # Create a line for 401k retirement
         retirement = {
             'move_id': bill_id,
-            'account_id': code_ids[self.get_account_code("retirement")],
+            'account_id': _account_id(code_ids, self.get_account_code("retirement")),
             'name': f"{self.department} {self.description.title()} 401k Retirement",
             'quantity': 1,
             'price_unit': self.retirement,
@@ -458,19 +1050,26 @@ class PayrollBillLine:
 
 class XLPayrollFile:
 
-    def __init__(self, filename: str, load=False):
+    def __init__(self, filename: str, load=False, config: dict = None, contents: bytes = None):
         """
         Represents the Excel payroll file
         :param filename: payroll file
         :type filename: str
         :param load: whether to load the payroll data on class instantiation
         :type load: bool
+        :param config: the loaded config file, for the header cell locations
+        :type config: dict
+        :param contents: file contents, if already in memory. filename is then only used in messages
+        :type contents: bytes
         """
 
         self.header_data: dict[str: str]
-        self.pay_data: dict[int: list[dict]]
+        self.pay_columns: list[str] = []
+        self.pay_data: list[list]
 
         self.filename: str = filename
+        self.config: dict = config or {}
+        self.contents: bytes = contents
 
         if load:
             self.read_xl_file()
@@ -478,22 +1077,23 @@ class XLPayrollFile:
     def read_xl_file(self) -> None:
         """
         This method causes the Excel payroll file to be read into the instance, stored in
-        self.header_data and self.pay_data
+        self.header_data, self.pay_columns and self.pay_data
         :return: None
         :rtype: None
         """
         book: xlrd.Book
 
         try:
-            book: xlrd.Book = xlrd.open_workbook(self.filename)
+            if self.contents is not None:
+                book: xlrd.Book = xlrd.open_workbook(file_contents=self.contents)
+            else:
+                book: xlrd.Book = xlrd.open_workbook(self.filename)
 
             # We *asume* we're always working with the first sheet
             sheet: xlrd.sheet.Sheet = book.sheet_by_index(0)
 
-        except (IOError, FileNotFoundError) as e:
-            print(e, file=sys.stderr)
-            print(f"There was a problem opening or reading XL file {self.filename}. Exiting.", file=sys.stderr)
-            sys.exit(1)
+        except (IOError, FileNotFoundError, xlrd.XLRDError) as e:
+            raise PayrollFileError(f"There was a problem opening or reading XL file {self.filename}: {e}") from e
 
         self.header_data = self._read_payroll_header(book, sheet)
         self.pay_data = self._read_pay_data(sheet)
@@ -501,8 +1101,8 @@ class XLPayrollFile:
     def _read_payroll_header(self, book: xlrd.Book, sheet: xlrd.sheet.Sheet) -> dict:
         results: dict
 
-        xrow = lambda x: config['xl-cell-locations']['header'][x][0]
-        ycol = lambda y: config['xl-cell-locations']['header'][y][1]
+        xrow = lambda x: _config_value(self.config, 'xl-cell-locations', 'header', x)[0]
+        ycol = lambda y: _config_value(self.config, 'xl-cell-locations', 'header', y)[1]
 
         results = {
             'paygroup': sheet.cell_value(xrow('paygroup'), ycol('paygroup')),
@@ -532,11 +1132,9 @@ class XLPayrollFile:
                         break
             index += 1
 
-        data: list = [sheet.row_values(line) for line in range(start_block, end_block)]
-
-        # Make a list dictionary for easy access, like a CSVDict
-        data_dict: list = [dict(zip(data[0], v)) for v in data[1:]]
-        return data_dict
+        # The first row holds the column names, the rest are left as raw rows for the column schema extractors
+        self.pay_columns = sheet.row_values(start_block)
+        return [sheet.row_values(line) for line in range(start_block + 1, end_block)]
 
 
 def main():
@@ -546,51 +1144,48 @@ def main():
     parser.add_argument('-c', '--config', dest='configfile', type=str, required=False,
                         default='/usr/local/etc/prupload.conf',
                         help='specify a different config file (default "/usr/local/etc/prupload.conf")')
-    parser.add_argument('-s', '--server', dest='server', type=str, required=False, default='odoo',
-                        help='specify a different server config to use from config file (default "odoo")')
+    parser.add_argument('-s', '--server', dest='servers', type=_server_list, required=False, default=['odoo'],
+                        help='specify a different server config to use from config file, or a comma separated '
+                             'list of them to upload the same bill to each (default "odoo")')
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+                        help='update the existing draft vendor bill with the same reference instead of creating one')
     parser.add_argument('input', metavar='input', type=str, help='payroll cvs filename')
 
     args = parser.parse_args()
 
-    global server
-    server = args.server
-
-    with open(args.configfile) as f:
-        global config, url, db, username, password, uid, code_ids
-
-        config = yaml.safe_load(f)
-
-        # get login info from the config file and store in globals
-        url = config[server]['url']
-        db = config[server]['database']
-        username = config[server]['username']
-        password = config[server]['password']
-
-    # get uid of user
-    with xmlrpc.client.ServerProxy(f"{url}/xmlrpc/2/common", allow_none=True,
-                                   context=ssl._create_unverified_context()) as common:
-        # uid is global
-        uid = common.authenticate(db, username, password, {})
+    try:
+        with open(args.configfile) as f:
+            cli_config: dict = yaml.safe_load(f)
+
+        sessions: list[OdooSession] = [OdooSession(cli_config, name) for name in args.servers]
+
+        with open(args.input, newline='') as infile:
+            # The file is parsed once and the same bill is sent to every server
+            bill: PayrollBill = PayrollBill.load(infile, cli_config)
+    except (OSError, PayrollError) as e:
+        print(f"{e}. Exiting.", file=sys.stderr)
+        sys.exit(1)
+
+    results = PayrollBill.save_all(bill, sessions, update=args.update)
+
+    failed = False
+    for session in sessions:
+        result, elapsed = results[session.server]
+        if isinstance(result, Exception):
+            failed = True
+            print(f"{session.server}: upload failed after {elapsed:.2f}s: {result}", file=sys.stderr)
+        else:
+            print(f"\n{session.server} ({elapsed:.2f}s): {session.bill_url(result)}\n")
 
-    # Get ids of account codes
-    with xmlrpc.client.ServerProxy(f'{url}/xmlrpc/2/object', allow_none=True,
-                                   context=ssl._create_unverified_context()) as models:
-        codes = models.execute_kw(db, uid, password, 'account.account', 'search_read',
-                                  [[['deprecated', '=', False]]],
-                                  {'fields': ['code', 'id']}
-                                  )
-    # code_ids are global
-    code_ids = {rec['code']: rec['id'] for rec in codes}
+    if failed:
+        sys.exit(1)
 
     with open(args.input, newline='') as infile:
-        bill: PayrollBill = PayrollBill.load(infile)
-        bill_id = PayrollBill.save(bill)
-        print(f"\n{url}/web#id={bill_id}&cids=1&menu_id=240&action=1237&model=account.move&view_type=form\n")
         # See if we can tag the file on MacOS
         try:
             tag = macos_tags.Tag("Done", color=macos_tags.Color.GRAY)
             macos_tags.add(tag, file=infile)
-        except ModuleNotFoundError:
+        except (ModuleNotFoundError, NameError):
             pass
 
         # Rename clunky XL file name, if applicable
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import queue
+import threading
+import time
+import urllib.request
+from unittest import TestCase
+
+from testing_helpers import config, odoo_session
+from prserver import PayrollQueue, PayrollHTTPServer, _read_upload
+from prupload import OdooSession
+
+BOUNDARY = 'payroll-test-boundary'
+
+
+def _multipart(filename: str, data: bytes) -> bytes:
+    return (f'--{BOUNDARY}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+
+class TestReadUpload(TestCase):
+
+    def test_read_upload(self):
+        with open('new_test_data.xls', 'rb') as f:
+            data = f.read()
+
+        filename, contents = _read_upload(f'multipart/form-data; boundary={BOUNDARY}',
+                                          _multipart('../new_test_data.xls', data))
+
+        self.assertEqual(filename, 'new_test_data.xls')
+        self.assertEqual(contents, data)
+
+    def test_read_upload_without_file(self):
+        with self.assertRaises(ValueError):
+            _read_upload('text/plain', b'not a form')
+
+
+class TestContentLength(TestCase):
+
+    def setUp(self) -> None:
+        self.httpd = PayrollHTTPServer(('127.0.0.1', 0), PayrollQueue(OdooSession(config, 'odoo-dev'), workers=0))
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _post_status(self, content_length) -> int:
+        connection = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=5)
+        connection.putrequest('POST', '/jobs')
+        if content_length is not None:
+            connection.putheader('Content-Length', content_length)
+        connection.endheaders()
+        status = connection.getresponse().status
+        connection.close()
+        return status
+
+    def test_missing_content_length(self):
+        self.assertEqual(self._post_status(None), 411)
+
+    def test_bad_content_length(self):
+        self.assertEqual(self._post_status('-1'), 400)
+        self.assertEqual(self._post_status('lots'), 400)
+
+
+class TestPayrollQueue(TestCase):
+
+    def test_queue_full(self):
+        payroll_queue = PayrollQueue(OdooSession(config, 'odoo-dev'), workers=0, queue_size=1)
+
+        payroll_queue.submit('test_data.csv', b'')
+        with self.assertRaises(queue.Full):
+            payroll_queue.submit('test_data.csv', b'')
+
+    def test_upload_and_poll(self):
+        payroll_queue = PayrollQueue(odoo_session(self), workers=2)
+        payroll_queue.start()
+        httpd = PayrollHTTPServer(('127.0.0.1', 0), payroll_queue)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+        try:
+            with open('test_data.csv', 'rb') as f:
+                request = urllib.request.Request(f"{base_url}/jobs", data=_multipart('test_data.csv', f.read()),
+                                                 headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.status, 202)
+                job = json.load(response)
+
+            deadline = time.monotonic() + 10
+            while job['status'] in ('queued', 'running'):
+                if time.monotonic() > deadline:
+                    self.fail(f"Job did not finish in time: {job}")
+                time.sleep(0.05)
+                with urllib.request.urlopen(f"{base_url}/jobs/{job['id']}") as response:
+                    job = json.load(response)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            payroll_queue.stop()
+
+        self.assertEqual(job['status'], 'done', job['error'])
+        self.assertEqual(job['ref'], '1QR-2022-W20-1')
+        assert job['move_id'] > 0
+        print(f"Vendor Bill id = {job['move_id']}")
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import argparse
+import gzip
+import json
+import tempfile
 from csv import DictReader
 from datetime import date
+from pathlib import Path
 from unittest import TestCase
 
 import prupload
-from prupload import PayrollBill, PayrollBillLine, _clean_file, XLPayrollFile
+from testing_helpers import ODOO_DEV, config, odoo_session, synthetic
+from prupload import PayrollBill, PayrollBillLine, _clean_file, _server_list, XLPayrollFile, parse_payroll, \
+    UnbalancedBillError, UnknownDepartmentError, PayrollFileError, diff_move_lines, column_schema, \
+    compile_line_extractor, OdooSession, OdooError, PayrollError, XMLRPCTransport, JSONRPCTransport, \
+    RecordingTransport, ReplayTransport
 
 
 class TestPayrollBill(TestCase):
@@ -25,7 +34,7 @@ class TestPayrollBill(TestCase):
         self.assertEqual(PayrollBill().invoice_total, 0)
 
     def test_load_csv(self):
-        test_bill = PayrollBill.load(self.csvfile)
+        test_bill = PayrollBill.load(self.csvfile, config)
 
         self.assertEqual(test_bill.date, date(2022, 5, 13))
         self.assertEqual(test_bill.ref, '1QR-2022-W20-1')
@@ -33,7 +42,7 @@ class TestPayrollBill(TestCase):
         self.assertEqual(test_bill.invoice_total, 28356.58)
 
     def test_load_xl(self):
-        test_bill:prupload.PayrollBill = PayrollBill.load(self.xl_file)
+        test_bill:prupload.PayrollBill = PayrollBill.load(self.xl_file, config)
 
         self.assertEqual(test_bill.date, date(2023, 3, 24))
         self.assertEqual(test_bill.ref, '6RZ20231301')
@@ -42,7 +51,7 @@ class TestPayrollBill(TestCase):
         self.assertTrue(test_bill.is_balanced)
 
     def test_load_xl2(self):
-        test_bill: prupload.PayrollBill = PayrollBill.load(self.xl_file2)
+        test_bill: prupload.PayrollBill = PayrollBill.load(self.xl_file2, config)
 
         self.assertEqual(test_bill.date, date(2023, 3, 24))
         self.assertEqual(test_bill.ref, '1QR20231301')
@@ -50,31 +59,129 @@ class TestPayrollBill(TestCase):
         self.assertEqual(len(test_bill.payroll_lines), 5)
         self.assertTrue(test_bill.is_balanced)
 
+    def test_parse_payroll(self):
+        with open('new_test_data2.xls', 'rb') as f:
+            test_bill = parse_payroll(f.read(), 'new_test_data2.xls', config)
+
+        self.assertEqual(test_bill.ref, '1QR20231301')
+        self.assertEqual(test_bill.invoice_total, 18076.51)
+
+    def test_parse_payroll_not_a_payroll_file(self):
+        with self.assertRaises(PayrollFileError):
+            parse_payroll(b"not a payroll file", 'notes.txt', config)
+
+    def test_parse_payroll_missing_cell_locations(self):
+        header = {key: value for key, value in config['xl-cell-locations']['header'].items() if key != 'total'}
+        missing = dict(config, **{'xl-cell-locations': {'header': header}})
+
+        with open('new_test_data2.xls', 'rb') as f:
+            data = f.read()
+        with self.assertRaisesRegex(PayrollError, 'no xl-cell-locations/header/total entry') as raised:
+            parse_payroll(data, 'new_test_data2.xls', missing)
+        self.assertNotIsInstance(raised.exception, PayrollFileError)
+
+    def test_save_unbalanced(self):
+        bill = PayrollBill.load(self.xl_file2, config)
+        bill.file_total += 1
+
+        with self.assertRaises(UnbalancedBillError):
+            PayrollBill.save(bill, OdooSession(config, 'odoo-dev'))
+
     def test_save_csv(self):
-        bill = PayrollBill.load(self.csvfile)
+        bill = PayrollBill.load(self.csvfile, config)
 
-        PayrollBill.save(bill)
+        PayrollBill.save(bill, odoo_session(self))
 
         assert bill.id > 0
         print(f"Vendor Bill id = {bill.id}")
 
     def test_save_xl(self):
-        bill = PayrollBill.load(self.xl_file)
+        bill = PayrollBill.load(self.xl_file, config)
 
-        PayrollBill.save(bill)
+        PayrollBill.save(bill, odoo_session(self))
 
         assert bill.id > 0
         print(f"XL Vendor Bill 1 id = {bill.id}")
 
 
     def test_save_xl2(self):
-        bill = PayrollBill.load(self.xl_file2)
+        bill = PayrollBill.load(self.xl_file2, config)
 
-        PayrollBill.save(bill)
+        PayrollBill.save(bill, odoo_session(self))
 
         assert bill.id > 0
         print(f"XL Vendor Bill 2 id = {bill.id}")
 
+    def test_update(self):
+        session = odoo_session(self)
+        bill = PayrollBill.load(self.csvfile, config)
+        bill.ref += '-UPDATE-TEST'
+        bill_id = PayrollBill.save(bill, session)
+        # Remove the bill again, so update finds only this one next time
+        self.addCleanup(session.execute_kw, 'account.move', 'unlink', [[bill_id]])
+
+        # ADP corrects the first department and drops the last fee line
+        corrected = bill.payroll_lines[0]
+        corrected.earnings += 100
+        corrected.total += 100
+        del bill.payroll_lines[-1]
+
+        self.assertEqual(PayrollBill.update(bill, session), bill_id)
+
+        # The fake server's idea of how write applies line commands says nothing about Odoo's
+        if synthetic(self):
+            return
+
+        lines = session.execute_kw('account.move.line', 'search_read', [[['move_id', '=', bill_id]]],
+                                   {'fields': list(prupload.MOVE_LINE_FIELDS)})
+        earnings = [l for l in lines if l['name'] == f"{corrected.department} Office Earnings"]
+        self.assertEqual(earnings[0]['price_unit'], corrected.earnings)
+        # 6 departments with 4 lines each and the remaining fee only line
+        self.assertEqual(len([l for l in lines if not l['exclude_from_invoice_tab']]), 6 * 4 + 1)
+
+    def test_save_all(self):
+        bill = PayrollBill.load(self.csvfile, config)
+
+        session = odoo_session(self)
+        results = PayrollBill.save_all(bill, [session])
+
+        bill_id, elapsed = results[session.server]
+        assert bill_id > 0
+        assert elapsed > 0
+        self.assertEqual(bill.id, 0)
+        print(f"Vendor Bill id on {session.server} = {bill_id}")
+
+    def test_save_all_with_failing_server(self):
+        bill = PayrollBill.load(self.csvfile, config)
+        session = odoo_session(self)
+
+        # A second server that turns the login down
+        cassette_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cassette_dir.cleanup)
+        cassette = Path(cassette_dir.name) / 'cassette.json'
+        down = OdooSession(dict(config, **{'odoo-down': config['odoo-dev']}), 'odoo-down')
+        request = {'service': 'common', 'method': 'authenticate', 'args': [down.db, down.username, '********', {}]}
+        cassette.write_text(json.dumps({'interactions': [{'request': request, 'error': 'Access Denied'}]}))
+        down.transport = ReplayTransport(cassette)
+
+        results = PayrollBill.save_all(bill, [session, down])
+
+        bill_id, elapsed = results[session.server]
+        assert bill_id > 0
+        assert elapsed > 0
+        error, down_elapsed = results[down.server]
+        self.assertIsInstance(error, OdooError)
+        self.assertIn('Access Denied', str(error))
+        assert down_elapsed > 0
+        down.transport.assert_finished()
+
+    def test_server_list(self):
+        self.assertEqual(_server_list("odoo"), ["odoo"])
+        self.assertEqual(_server_list("odoo, odoo-dev,"), ["odoo", "odoo-dev"])
+        self.assertEqual(_server_list("odoo-dev,odoo,odoo-dev"), ["odoo-dev", "odoo"])
+        with self.assertRaises(argparse.ArgumentTypeError):
+            _server_list(" , ")
+
 
 class TestPayrollBillLine(TestCase):
     def setUp(self) -> None:
@@ -92,10 +199,16 @@ class TestPayrollBillLine(TestCase):
             earnings=line['Gross Earnings'],
             fees=line['Total Fee'],
             deductions=line['Deduct Adjust'],
-            retirement=line['Employer Contrib (401k)']
+            retirement=line['Employer Contrib (401k)'],
+            config=config
         )
         return test_payroll_line
 
+    def _code_ids(self) -> dict:
+        # Made up ids for every account code in the config, no server needed to build journal items
+        codes = {*config['accounts']['departments'].values(), *config['accounts']['expenses'].values(), "20100"}
+        return {code: n for n, code in enumerate(sorted(codes), 1)}
+
     def _calculate_total(self, payroll_line):
         return round(payroll_line.earnings + payroll_line.fees +
                      payroll_line.deductions + payroll_line.retirement, 2)
@@ -153,11 +266,31 @@ class TestPayrollBillLine(TestCase):
         self.assertEqual(payroll_line.get_account_code("retirement"), "75900")
         self.assertFalse(payroll_line.is_fee_only)
 
+    def test_unknown_department(self):
+        line = dict(self.payroll_lines[0], **{'Worked Department #': '000999'})
+        payroll_line = self._get_new_payroll_line(line)
+
+        with self.assertRaises(UnknownDepartmentError):
+            payroll_line.get_account_code("earnings")
+
+    def test_missing_config_section(self):
+        payroll_line = self._get_new_payroll_line(self.payroll_lines[1])
+        payroll_line.config = {key: value for key, value in config.items() if key != 'direct-labor-departments'}
+
+        with self.assertRaisesRegex(PayrollError, 'direct-labor-departments'):
+            payroll_line.get_account_code("fees")
+
+    def test_unknown_account_code(self):
+        payroll_line = self._get_new_payroll_line(self.payroll_lines[1])
+
+        with self.assertRaisesRegex(PayrollError, 'Account code 50370'):
+            payroll_line.to_odoo_values(1234, {})
+
     def test_to_odoo_values_regular_line(self):
         """Test direct labor payroll line"""
         payroll_line = self._get_new_payroll_line(self.payroll_lines[1])
 
-        entries = payroll_line.to_odoo_values(1234)
+        entries = payroll_line.to_odoo_values(1234, self._code_ids())
 
         self.assertEqual(len(entries), 4)
 
@@ -165,20 +298,172 @@ class TestPayrollBillLine(TestCase):
         """Test direct labor payroll line"""
         payroll_line = self._get_new_payroll_line(self.payroll_lines[7])
 
-        entries = payroll_line.to_odoo_values(1234)
+        entries = payroll_line.to_odoo_values(1234, self._code_ids())
 
         self.assertEqual(len(entries), 1)
 
 
+class TestDiffMoveLines(TestCase):
+
+    def setUp(self) -> None:
+        self.existing = [
+            {'id': 1, 'name': '10 Office Earnings', 'account_id': [5, '70200 Office'], 'quantity': 1.0,
+             'price_unit': 100.0, 'credit': 0.0, 'exclude_from_invoice_tab': False},
+            {'id': 2, 'name': '10 Office Payroll Fees', 'account_id': [6, '70550 Fees'], 'quantity': 1.0,
+             'price_unit': 10.0, 'credit': 0.0, 'exclude_from_invoice_tab': False},
+            {'id': 3, 'name': False, 'account_id': [9, '20100 A/P'], 'quantity': 1.0,
+             'price_unit': 0.0, 'credit': 110.0, 'exclude_from_invoice_tab': True},
+        ]
+        self.new = [
+            {'move_id': 7, 'account_id': 5, 'name': '10 Office Earnings', 'quantity': 1, 'price_unit': 100.0,
+             'exclude_from_invoice_tab': False},
+            {'move_id': 7, 'account_id': 6, 'name': '10 Office Payroll Fees', 'quantity': 1, 'price_unit': 10.0,
+             'exclude_from_invoice_tab': False},
+            {'move_id': 7, 'account_id': 9, 'credit': 110.0, 'exclude_from_invoice_tab': True},
+        ]
+
+    def test_unchanged(self):
+        self.assertEqual(diff_move_lines(self.existing, self.new, 9), ([], []))
+
+    def test_changed_line(self):
+        self.new[1]['price_unit'] = 12.5
+        self.new[2]['credit'] = 112.5
+
+        line_commands, offset_commands = diff_move_lines(self.existing, self.new, 9)
+
+        self.assertEqual(line_commands, [(1, 2, {'price_unit': 12.5})])
+        self.assertEqual(offset_commands, [(1, 3, {'credit': 112.5})])
+
+    def test_added_and_removed_lines(self):
+        self.new[0]['name'] = '20 Admin Earnings'
+
+        line_commands, offset_commands = diff_move_lines(self.existing, self.new, 9)
+
+        self.assertEqual(line_commands, [
+            (0, 0, {'account_id': 5, 'name': '20 Admin Earnings', 'quantity': 1, 'price_unit': 100.0,
+                    'exclude_from_invoice_tab': False}),
+            (2, 1),
+        ])
+        self.assertEqual(offset_commands, [])
+
+
+class TestTransports(TestCase):
+
+    def _session(self, **settings) -> OdooSession:
+        server_config = dict(config['odoo-dev'], **settings)
+        return OdooSession(dict(config, **{'odoo-dev': server_config}), 'odoo-dev')
+
+    def test_default_transport(self):
+        self.assertIsInstance(self._session().transport, XMLRPCTransport)
+
+    def test_missing_partner(self):
+        server_config = dict(config['odoo-dev'])
+        del server_config['partner-id']
+
+        with self.assertRaises(PayrollError):
+            OdooSession(dict(config, **{'odoo-dev': server_config}), 'odoo-dev')
+
+    def test_unknown_transport(self):
+        with self.assertRaises(PayrollError):
+            self._session(transport='carrier-pigeon')
+
+    def test_compressed_request_body(self):
+        transport = JSONRPCTransport('http://localhost:8069', compress=True)
+
+        body = json.loads(gzip.decompress(transport.request_body('object', 'execute_kw', [1, 2])))
+
+        self.assertEqual(body['params'], {'service': 'object', 'method': 'execute_kw', 'args': [1, 2]})
+
+    def test_xmlrpc_fault(self):
+        with self.assertRaises(OdooError):
+            XMLRPCTransport('http://localhost:8069').decode_response(
+                b"<?xml version='1.0'?><methodResponse><fault><value><struct>"
+                b"<member><name>faultCode</name><value><int>1</int></value></member>"
+                b"<member><name>faultString</name><value><string>Access Denied</string></value></member>"
+                b"</struct></value></fault></methodResponse>")
+
+    def test_jsonrpc_error(self):
+        with self.assertRaises(OdooError):
+            JSONRPCTransport('http://localhost:8069').decode_response(
+                b'{"jsonrpc":"2.0","id":1,"error":{"message":"Odoo Server Error","data":{"message":"Access Denied"}}}')
+
+    def test_jsonrpc_connect(self):
+        if not ODOO_DEV:
+            self.skipTest("Talks to the odoo-dev server over JSON-RPC, run with PRUPLOAD_CASSETTES=live")
+
+        session = self._session(transport='jsonrpc')
+        session.connect()
+        xmlrpc_session = self._session()
+        xmlrpc_session.connect()
+
+        self.assertEqual(session.code_ids, xmlrpc_session.code_ids)
+
+    def test_record_and_replay(self):
+        cassette_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cassette_dir.cleanup)
+        cassette = Path(cassette_dir.name) / 'cassette.json'
+
+        class FakeTransport(XMLRPCTransport):
+            def call(self, service, method, args):
+                if args[4] == 'unlink':
+                    raise OdooError("Record does not exist")
+                return len(args[5][0])
+
+        recorder = RecordingTransport(FakeTransport('http://localhost:8069'), cassette)
+        self.assertEqual(recorder.execute_kw('db', 2, 'secret', 'account.move.line', 'create', [[{}, {}]], {}), 2)
+        with self.assertRaises(OdooError):
+            recorder.execute_kw('db', 2, 'secret', 'account.move', 'unlink', [[1]], {})
+        recorder.save()
+        self.assertNotIn('secret', cassette.read_text())
+
+        replay = ReplayTransport(cassette)
+        self.assertEqual(replay.execute_kw('db', 2, 'other', 'account.move.line', 'create', [[{}, {}]], {}), 2)
+        with self.assertRaises(AssertionError):
+            replay.assert_finished()
+        with self.assertRaises(AssertionError):
+            replay.execute_kw('db', 2, 'other', 'account.move', 'unlink', [[2]], {})
+
+
+class TestColumnSchema(TestCase):
+    header = ['DEPARTMENT NUMBER', 'GROSS', 'TOTAL SVC FEE AMT', 'TLM SUBTOTAL', 'ADJ 31-MEDICAL',
+              'ADJ ER401K-401K MATCH', 'TOTAL']
+
+    def test_extract_line(self):
+        extract = compile_line_extractor(column_schema(config, 'excel'), self.header, config)
+
+        payroll_line = extract(['000020', 1000.0, 100.0, 10.0, '', 25.0, 1135.0])
+
+        self.assertEqual(payroll_line.department, 20)
+        self.assertEqual(payroll_line.earnings, 1000.0)
+        self.assertEqual(payroll_line.fees, 110.0)
+        self.assertEqual(payroll_line.deductions, 0.0)
+        self.assertEqual(payroll_line.retirement, 25.0)
+        self.assertEqual(payroll_line.total, 1135.0)
+
+    def test_config_override(self):
+        schemas = {'excel': {'deductions': ['ADJ 31-MEDICAL', 'TLM SUBTOTAL']}}
+        override = dict(config, **{'column-schemas': schemas})
+        extract = compile_line_extractor(column_schema(override, 'excel'), self.header, override)
+
+        payroll_line = extract(['000020', 1000.0, 100.0, 10.0, 5.0, 25.0, 1140.0])
+
+        self.assertEqual(payroll_line.deductions, 15.0)
+        self.assertEqual(payroll_line.fees, 110.0)
+
+    def test_missing_required_column(self):
+        with self.assertRaises(PayrollFileError):
+            compile_line_extractor(column_schema(config, 'excel'), self.header[1:], config)
+
+
 class TestXLPayrollFile(TestCase):
 
     def test_constructor(self):
-        payroll_file = XLPayrollFile('new_test_data.xls')
+        payroll_file = XLPayrollFile('new_test_data.xls', config=config)
         self.assertIsInstance(payroll_file, XLPayrollFile)
         self.assertEqual('new_test_data.xls', payroll_file.filename)
 
     def setUp(self) -> None:
-        self.reader = XLPayrollFile('new_test_data.xls')
+        self.reader = XLPayrollFile('new_test_data.xls', config=config)
 
     def test_read_xl_file(self):
         self.reader.read_xl_file()
@@ -199,8 +484,9 @@ class TestXLPayrollFile(TestCase):
 
         # Check line values
         pr_line = self.reader.pay_data[1]
+        column = self.reader.pay_columns.index
 
-        self.assertEqual(int(pr_line['DEPARTMENT NUMBER']), 20)
-        self.assertEqual(int(pr_line['GROSS']), 4900.0)
-        self.assertEqual(pr_line['TOTAL SVC FEE AMT'], 506.12)
+        self.assertEqual(int(pr_line[column('DEPARTMENT NUMBER')]), 20)
+        self.assertEqual(int(pr_line[column('GROSS')]), 4900.0)
+        self.assertEqual(pr_line[column('TOTAL SVC FEE AMT')], 506.12)
 
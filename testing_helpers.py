@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+import yaml
+
+from fake_odoo import FakeOdoo, FakeOdooServer
+from prupload import OdooSession, RecordingTransport, ReplayTransport
+
+with open('test_config.yaml') as f:
+    config = yaml.safe_load(f)
+
+# Calls to Odoo are replayed from cassettes/, so the suite runs offline. PRUPLOAD_CASSETTES=record runs the
+# tests against the odoo-dev server and records the cassettes again, PRUPLOAD_CASSETTES=live skips them.
+# PRUPLOAD_CASSETTES=synthetic records against fake_odoo instead, into cassettes/synthetic/. Those pin down
+# what prupload sends, but the answers are the fake server's, not Odoo's.
+CASSETTE_MODE = os.environ.get('PRUPLOAD_CASSETTES', 'replay')
+CASSETTES = Path('cassettes')
+SYNTHETIC_CASSETTES = CASSETTES / 'synthetic'
+
+# Whether the tests talk to the real odoo-dev server
+ODOO_DEV = CASSETTE_MODE in ('record', 'live')
+
+if ODOO_DEV:
+    # Talking to the real server needs its url and password from the encrypted config file. The cassettes
+    # don't store the password, so they still replay with the one in test_config.yaml
+    with open('config.yaml') as f:
+        login = yaml.safe_load(f)['odoo-dev']
+    config['odoo-dev'].update(url=login['url'], password=login['password'])
+
+
+def cassette(test: TestCase) -> Path:
+    """:returns the cassette of a test. A cassette recorded from odoo-dev is preferred over a synthetic one"""
+
+    name = f"{test.id()}.json"
+    if CASSETTE_MODE == 'synthetic' or (CASSETTE_MODE == 'replay' and not (CASSETTES / name).exists()):
+        return SYNTHETIC_CASSETTES / name
+    return CASSETTES / name
+
+
+def synthetic(test: TestCase) -> bool:
+    """:returns whether a test gets its answers from fake_odoo, directly or from a cassette recorded with it.
+    Checks of how Odoo applies what it was sent mean nothing then."""
+
+    return CASSETTE_MODE in ('synthetic', 'replay') and cassette(test).parent == SYNTHETIC_CASSETTES
+
+
+def _fake_odoo_config(test: TestCase) -> dict:
+    """:returns the test config pointing odoo-dev at a fake Odoo server started for this test alone, so the
+    ids in its cassette don't depend on the tests that ran before"""
+
+    accounts = config['accounts']
+    codes = sorted({*accounts['departments'].values(), *accounts['expenses'].values(), "20100"})
+    server = FakeOdooServer(('127.0.0.1', 0), FakeOdoo(codes))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+
+    return dict(config, **{'odoo-dev': dict(config['odoo-dev'], url=server.url)})
+
+
+def odoo_session(test: TestCase) -> OdooSession:
+    """:returns logged in session of the odoo-dev server for a test, backed by the test's cassette"""
+
+    if CASSETTE_MODE == 'synthetic':
+        session = OdooSession(_fake_odoo_config(test), 'odoo-dev')
+    else:
+        session = OdooSession(config, 'odoo-dev')
+    path = cassette(test)
+
+    if CASSETTE_MODE in ('record', 'synthetic'):
+        session.transport = RecordingTransport(session.transport, path)
+        test.addCleanup(session.transport.save)
+    elif CASSETTE_MODE == 'replay':
+        if not path.exists():
+            test.skipTest(f"No cassette {path}, record it with PRUPLOAD_CASSETTES=record")
+        session.transport = ReplayTransport(path)
+        test.addCleanup(session.transport.assert_finished)
+
+    session.connect()
+    return session